@@ -15,12 +15,13 @@ def run_click_command(cmd, *args, **kw):
 
 def recursive_list_files(d="."):
     result = []
-    for d, subdirs, files in os.walk(d):
-        d = d.replace(os.path.sep, "/")
-        if d != ".":
-            result.append("/".join([d, ""])[2:])
-        for f in files:
-            result.append("/".join([d, f])[2:])
+    for dirpath, subdirs, files in os.walk(d):
+        rel = os.path.relpath(dirpath, d).replace(os.path.sep, "/")
+        if rel == ".":
+            result.extend(files)
+        else:
+            result.append(f"{rel}/")
+            result.extend(f"{rel}/{f}" for f in files)
     result.sort()
     return result
 
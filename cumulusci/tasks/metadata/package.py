@@ -1,39 +1,49 @@
-from pathlib import Path
+from functools import lru_cache
+import hashlib
+import json
 import os
 import re
 import urllib.parse
 import yaml
+from lxml import etree
 
+from cumulusci import __version__
 from cumulusci.core.tasks import BaseTask
-from cumulusci.utils import elementtree_parse_file
 
 __location__ = os.path.dirname(os.path.realpath(__file__))
 
 
-def metadata_sort_key(name):
-    sections = []
-    for section in re.split("[.|-]", name):
-        sections.append(metadata_sort_key_section(section))
+@lru_cache(1)
+def _load_metadata_map():
+    """Parse metadata_map.yml once per process; the file is static."""
+    with open(__location__ + "/metadata_map.yml", "r") as f_metadata_map:
+        return yaml.safe_load(f_metadata_map)
 
-    key = "_".join(sections)
-    key = key.replace("_", "Z")
 
-    return key
+@lru_cache(1)
+def _load_delete_excludes():
+    filename = os.path.join(__location__, "..", "..", "files", "delete_excludes.txt")
+    with open(filename, "r") as f:
+        return frozenset(line.strip() for line in f)
 
 
-def metadata_sort_key_section(name):
-    prefix = "5"
-    key = name
+_SORT_SPLIT_RE = re.compile(r"[.|\-]")
+_UNDERSCORE_TO_Z = str.maketrans("_", "Z")
 
-    # Sort namespace prefixed names last
-    base_name = name
-    if base_name.endswith("__c"):
-        base_name = base_name[:-3]
-    if "__" in base_name:
-        prefix = "8"
 
-    key = prefix + name
-    return key
+@lru_cache(8192)
+def metadata_sort_key(name):
+    return "_".join(
+        metadata_sort_key_section(section) for section in _SORT_SPLIT_RE.split(name)
+    ).translate(_UNDERSCORE_TO_Z)
+
+
+@lru_cache(8192)
+def metadata_sort_key_section(name):
+    # Sort namespace prefixed names last
+    base_name = name[:-3] if name.endswith("__c") else name
+    prefix = "8" if "__" in base_name else "5"
+    return prefix + name
 
 
 class MetadataParserMissingError(Exception):
@@ -52,8 +62,7 @@ class PackageXmlGenerator(object):
         uninstall_class=None,
         types=None,
     ):
-        with open(__location__ + "/metadata_map.yml", "r") as f_metadata_map:
-            self.metadata_map = yaml.safe_load(f_metadata_map)
+        self.metadata_map = _load_metadata_map()
         self.directory = directory
         self.api_version = api_version
         self.package_name = package_name
@@ -69,10 +78,13 @@ class PackageXmlGenerator(object):
         return self.render_xml()
 
     def parse_types(self):
-        for item in sorted(os.listdir(self.directory)):
+        with os.scandir(self.directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            item = entry.name
             if item == "package.xml":
                 continue
-            if not os.path.isdir(self.directory + "/" + item):
+            if not entry.is_dir():
                 continue
             if item.startswith("."):
                 continue
@@ -82,6 +94,11 @@ class PackageXmlGenerator(object):
                     "No parser configuration found for subdirectory %s" % item
                 )
 
+            # Empty subdirectories can't contribute members
+            with os.scandir(entry.path) as it:
+                if next(it, None) is None:
+                    continue
+
             for parser_config in config:
                 options = parser_config.get("options") or {}
                 parser = globals()[parser_config["class"]](
@@ -94,26 +111,22 @@ class PackageXmlGenerator(object):
                 self.types.append(parser)
 
     def render_xml(self):
-        lines = []
-
         # Print header
-        lines.append('<?xml version="1.0" encoding="UTF-8"?>')
-        lines.append('<Package xmlns="http://soap.sforce.com/2006/04/metadata">')
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<Package xmlns="http://soap.sforce.com/2006/04/metadata">',
+        ]
         if self.package_name:
             package_name_encoded = urllib.parse.quote(self.package_name, safe=" ")
-            lines.append("    <fullName>{0}</fullName>".format(package_name_encoded))
+            lines.append(f"    <fullName>{package_name_encoded}</fullName>")
 
         if self.managed and self.install_class:
             lines.append(
-                "    <postInstallClass>{0}</postInstallClass>".format(
-                    self.install_class
-                )
+                f"    <postInstallClass>{self.install_class}</postInstallClass>"
             )
 
         if self.managed and self.uninstall_class:
-            lines.append(
-                "    <uninstallClass>{0}</uninstallClass>".format(self.uninstall_class)
-            )
+            lines.append(f"    <uninstallClass>{self.uninstall_class}</uninstallClass>")
 
         # Print types sections
         self.types.sort(key=lambda x: x.metadata_type.upper())
@@ -123,8 +136,7 @@ class PackageXmlGenerator(object):
                 lines.extend(type_xml)
 
         # Print footer
-        lines.append("    <version>{0}</version>".format(self.api_version))
-        lines.append("</Package>")
+        lines.extend((f"    <version>{self.api_version}</version>", "</Package>"))
 
         return "\n".join(lines)
 
@@ -136,6 +148,8 @@ class BaseMetadataParser(object):
         self.extension = extension
         self.delete = delete
         self.members = []
+        self._seen = set()
+        self._entries = {}
 
         if self.delete:
             self.delete_excludes = self.get_delete_excludes()
@@ -145,18 +159,15 @@ class BaseMetadataParser(object):
         return self.render_xml()
 
     def get_delete_excludes(self):
-        filename = os.path.join(
-            __location__, "..", "..", "files", "delete_excludes.txt"
-        )
-        excludes = []
-        with open(filename, "r") as f:
-            for line in f:
-                excludes.append(line.strip())
-        return excludes
+        return _load_delete_excludes()
 
     def parse_items(self):
+        # Cache the directory entries so parsers can reuse their stat results
+        with os.scandir(self.directory) as it:
+            self._entries = {entry.name: entry for entry in it}
+
         # Loop through items
-        for item in sorted(os.listdir(self.directory)):
+        for item in sorted(self._entries):
             # on Macs this file is generated by the OS. Shouldn't be in the package.xml
             if item.startswith("."):
                 continue
@@ -187,8 +198,13 @@ class BaseMetadataParser(object):
         members = self._parse_item(item)
         if members:
             for member in members:
+                if isinstance(member, bytes):
+                    member = member.decode("utf-8")
                 # Translate filename namespace tokens into in-file namespace tokens
                 member = member.replace("___NAMESPACE___", "%%%NAMESPACE%%%")
+                if member in self._seen:
+                    continue
+                self._seen.add(member)
                 self.members.append(member)
 
     def _parse_item(self, item):
@@ -198,17 +214,24 @@ class BaseMetadataParser(object):
     def strip_extension(self, filename):
         return filename.rsplit(".", 1)[0]
 
+    def is_dir(self, item):
+        entry = self._entries.get(item)
+        if entry is not None:
+            return entry.is_dir()
+        return os.path.isdir(self.directory + "/" + item)
+
+    def exists(self, item):
+        if self._entries:
+            return item in self._entries
+        return os.path.lexists(self.directory + "/" + item)
+
     def render_xml(self):
-        output = []
         if not self.members:
             return
-        output.append("    <types>")
         self.members.sort(key=metadata_sort_key)
-        for member in self.members:
-            if isinstance(member, bytes):
-                member = member.decode("utf-8")
-            output.append("        <members>{0}</members>".format(member))
-        output.append("        <name>{0}</name>".format(self.metadata_type))
+        output = ["    <types>"]
+        output.extend(f"        <members>{member}</members>" for member in self.members)
+        output.append(f"        <name>{self.metadata_type}</name>")
         output.append("    </types>")
         return output
 
@@ -224,15 +247,17 @@ class MetadataFolderParser(BaseMetadataParser):
         path = self.directory + "/" + item
 
         # Skip non-directories
-        if not os.path.isdir(path):
+        if not self.is_dir(item):
             return members
 
         # Only add the folder itself if its -meta.xml is present
         # (If there's no -meta.xml, this package is adding items to an existing folder.)
-        if Path(path + "-meta.xml").exists():
+        if self.exists(item + "-meta.xml"):
             members.append(item)
 
-        for subitem in sorted(os.listdir(path)):
+        with os.scandir(path) as it:
+            subitems = sorted(entry.name for entry in it)
+        for subitem in subitems:
             if subitem.endswith("-meta.xml") or subitem.startswith("."):
                 continue
             submembers = self._parse_subitem(item, subitem)
@@ -277,9 +302,11 @@ class MetadataXmlElementParser(BaseMetadataParser):
         if not name_xpath:
             name_xpath = "./sf:fullName"
         self.name_xpath = name_xpath
+        self._item_finder = etree.XPath(item_xpath, namespaces=self.namespaces)
+        self._name_finder = etree.XPath(name_xpath, namespaces=self.namespaces)
 
     def _parse_item(self, item):
-        root = elementtree_parse_file(self.directory + "/" + item)
+        root = etree.parse(self.directory + "/" + item).getroot()
         members = []
 
         parent = self.strip_extension(item)
@@ -293,10 +320,10 @@ class MetadataXmlElementParser(BaseMetadataParser):
         return False
 
     def get_item_elements(self, root):
-        return root.findall(self.item_xpath, self.namespaces)
+        return self._item_finder(root)
 
     def get_name_elements(self, item):
-        return item.findall(self.name_xpath, self.namespaces)
+        return self._name_finder(item)
 
     def get_item_name(self, item, parent):
         """ Returns the value of the first name element found inside of element """
@@ -324,20 +351,17 @@ class CustomLabelsParser(MetadataXmlElementParser):
 
 
 class CustomObjectParser(MetadataFilenameParser):
+    custom_suffixes = ("__c.object", "__mdt.object", "__e.object", "__b.object")
+
     def _parse_item(self, item):
         members = []
 
         # Skip namespaced custom objects
-        if len(item.split("__")) > 2:
+        if item.count("__") > 1:
             return members
 
         # Skip standard objects
-        if (
-            not item.endswith("__c.object")
-            and not item.endswith("__mdt.object")
-            and not item.endswith("__e.object")
-            and not item.endswith("__b.object")
-        ):
+        if not item.endswith(self.custom_suffixes):
             return members
 
         members.append(self.strip_extension(item))
@@ -359,10 +383,9 @@ class BusinessProcessParser(MetadataXmlElementParser):
 class BundleParser(BaseMetadataParser):
     def _parse_item(self, item):
         members = []
-        path = self.directory + "/" + item
 
         # Skip non-directories
-        if not os.path.isdir(path):
+        if not self.is_dir(item):
             return members
 
         # item is a directory; add directory to members and ignore processing directory's files
@@ -374,10 +397,9 @@ class BundleParser(BaseMetadataParser):
 class LWCBundleParser(BaseMetadataParser):
     def _parse_item(self, item):
         members = []
-        path = self.directory + "/" + item
 
         # Skip non-directories
-        if not os.path.isdir(path) or item.startswith("__"):
+        if not self.is_dir(item) or item.startswith("__"):
             return members
 
         # item is a directory; add directory to members and ignore processing directory's files
@@ -438,6 +460,104 @@ class UpdatePackageXml(BaseTask):
         self.logger.info(
             "Generating {} from metadata in {}".format(output, self.options.get("path"))
         )
-        package_xml = self.package_xml()
+        package_xml = self._get_package_xml(output)
         with open(self.options.get("output", output), mode="w") as f:
             f.write(package_xml)
+
+    def _get_package_xml(self, output):
+        """Generate the package.xml, reusing the cached copy if no metadata changed"""
+        if not self.project_config.repo_root:
+            return self.package_xml()
+
+        cache_name, fingerprint = self._get_cache_key(output)
+        with self.project_config.open_cache("package_xml") as cache_dir:
+            cache_file = cache_dir / f"{cache_name}.json"
+            if cache_file.exists():
+                try:
+                    with cache_file.open("r") as f:
+                        cached = json.load(f)
+                    if cached["fingerprint"] == fingerprint:
+                        self.logger.info(
+                            "Metadata is unchanged; using cached package.xml"
+                        )
+                        return cached["package_xml"]
+                except (ValueError, KeyError, TypeError):
+                    self.logger.warning("Ignoring unreadable package.xml cache entry")
+
+        package_xml = self.package_xml()
+
+        with self.project_config.open_cache("package_xml") as cache_dir:
+            self._write_cache_file(
+                cache_dir,
+                f"{cache_name}.json",
+                {"fingerprint": fingerprint, "package_xml": package_xml},
+            )
+        return package_xml
+
+    def _write_cache_file(self, cache_dir, name, data):
+        # Write to a temp resource and rename it so an interrupted run
+        # can't leave a truncated cache entry behind
+        cache_file = cache_dir / name
+        tmp_file = cache_dir / f"{name}.{os.getpid()}.tmp"
+        try:
+            with tmp_file.open("w") as f:
+                json.dump(data, f)
+            # Both resources live in cache_dir, so their filenames are
+            # relative to the same filesystem root
+            tmp_file.fs.move(tmp_file.filename, cache_file.filename, overwrite=True)
+        except BaseException:
+            if tmp_file.exists():
+                tmp_file.unlink()
+            raise
+
+    def _get_cache_key(self, output):
+        """Returns (cache name for these settings, fingerprint of the metadata tree)"""
+        generator = self.package_xml
+        directory = os.path.abspath(generator.directory)
+        metadata_map_stat = os.stat(__location__ + "/metadata_map.yml")
+        settings = [
+            __version__,
+            metadata_map_stat.st_mtime_ns,
+            metadata_map_stat.st_size,
+            directory,
+            generator.api_version,
+            generator.package_name,
+            generator.managed,
+            generator.delete,
+            generator.install_class,
+            generator.uninstall_class,
+        ]
+        cache_name = hashlib.blake2b(
+            json.dumps(settings).encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+        # Walk the tree the way the parsers read it: follow symlinks
+        # and skip dot-prefixed entries (which also excludes .cci and .git)
+        skip = {os.path.join(directory, "package.xml"), os.path.abspath(output)}
+        seen = set()
+        h = hashlib.blake2b()
+        for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+            # Bundle parsers add a member per subdirectory, even an empty one
+            h.update(f"{os.path.relpath(dirpath, directory)}/\0".encode("utf-8"))
+            realpath = os.path.realpath(dirpath)
+            if realpath in seen:
+                # Already hashed via another link; also guards against loops
+                dirnames[:] = []
+                continue
+            seen.add(realpath)
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if name.startswith(".") or path in skip:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # e.g. a broken symlink
+                    h.update(f"{os.path.relpath(path, directory)}\0-\0".encode("utf-8"))
+                    continue
+                h.update(
+                    f"{os.path.relpath(path, directory)}\0"
+                    f"{stat.st_mtime_ns}\0{stat.st_size}\0".encode("utf-8")
+                )
+        return cache_name, h.hexdigest()
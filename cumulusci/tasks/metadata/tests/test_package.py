@@ -1,7 +1,10 @@
 from unittest import mock
+import json
 import os
 import unittest
 
+from lxml import etree
+
 from cumulusci.core.config import UniversalConfig
 from cumulusci.core.config import BaseProjectConfig
 from cumulusci.core.config import TaskConfig
@@ -35,6 +38,19 @@ class TestPackageXmlGenerator(unittest.TestCase):
         md.sort(key=metadata_sort_key)
         self.assertEqual(["Test__c", "a__Test__c"], md)
 
+    def test_metadata_sort_key__sections(self):
+        md = ["Test__c.ns__Field__c", "Test__c.Field__c", "Test__c-Layout"]
+        md.sort(key=metadata_sort_key)
+        self.assertEqual(
+            ["Test__c.Field__c", "Test__c-Layout", "Test__c.ns__Field__c"], md
+        )
+
+    def test_metadata_sort_key__cached(self):
+        metadata_sort_key.cache_clear()
+        metadata_sort_key("Test__c")
+        metadata_sort_key("Test__c")
+        self.assertEqual(1, metadata_sort_key.cache_info().hits)
+
     def test_package_name_urlencoding(self):
         api_version = "36.0"
         package_name = "Test & Package"
@@ -86,6 +102,24 @@ class TestPackageXmlGenerator(unittest.TestCase):
             with self.assertRaises(MetadataParserMissingError):
                 generator.parse_types()
 
+    def test_parse_types__skips_empty_directories(self):
+        with temporary_dir() as path:
+            os.mkdir(os.path.join(path, "classes"))
+            os.mkdir(os.path.join(path, "objects"))
+            touch(os.path.join("objects", "Test__c.object"))
+            generator = PackageXmlGenerator(path, "43.0", "Test Package")
+            generator.parse_types()
+        types = [parser.metadata_type for parser in generator.types]
+        self.assertIn("CustomObject", types)
+        self.assertNotIn("ApexClass", types)
+
+    def test_metadata_map_loaded_once(self):
+        with temporary_dir() as path:
+            first = PackageXmlGenerator(path, "43.0")
+            second = PackageXmlGenerator(path, "43.0")
+        self.assertIs(first.metadata_map, second.metadata_map)
+        self.assertIn("classes", first.metadata_map)
+
     def test_render_xml__managed(self):
         with temporary_dir() as path:
             generator = PackageXmlGenerator(
@@ -129,6 +163,16 @@ class TestBaseMetadataParser(unittest.TestCase):
             parser.parse_items()
             parser.parse_item.assert_called_once()
 
+    def test_check_delete_excludes(self):
+        parser = BaseMetadataParser("TestMDT", None, "object", delete=True)
+        self.assertTrue(parser.check_delete_excludes("Account.object"))
+        self.assertFalse(parser.check_delete_excludes("Custom__c.object"))
+
+    def test_get_delete_excludes__shared(self):
+        first = BaseMetadataParser("TestMDT", None, "object", delete=True)
+        second = BaseMetadataParser("TestMDT", None, "object", delete=True)
+        self.assertIs(first.delete_excludes, second.delete_excludes)
+
     def test_check_delete_excludes__not_deleting(self):
         parser = BaseMetadataParser("TestMDT", None, "object", delete=False)
         self.assertFalse(parser.check_delete_excludes("asdf"))
@@ -156,6 +200,14 @@ class TestMetadataFilenameParser(unittest.TestCase):
             parser.parse_items()
         self.assertEqual(["%%%NAMESPACE%%%Foo__c"], parser.members)
 
+    def test_parse_items__no_duplicates(self):
+        with temporary_dir() as path:
+            touch("Foo__c.object")
+            parser = MetadataFilenameParser("TestMDT", path, "object", delete=False)
+            parser.parse_items()
+            parser.parse_items()
+        self.assertEqual(["Foo__c"], parser.members)
+
 
 class TestMetadataFolderParser(unittest.TestCase):
     def test_parse_item(self):
@@ -173,6 +225,20 @@ class TestMetadataFolderParser(unittest.TestCase):
             parser = MetadataFolderParser("TestMDT", path, "object", delete=False)
             self.assertEqual(["Test", "Test/Test"], parser._parse_item("Test"))
 
+    def test_parse_items__uses_cached_entries(self):
+        with temporary_dir() as path:
+            os.mkdir(os.path.join(path, "Test"))
+            os.mkdir(os.path.join(path, "FolderWithoutMetaXml"))
+            touch("Test-meta.xml")
+            touch(os.path.join("Test", "Test.object"))
+            touch(os.path.join("FolderWithoutMetaXml", "Other.object"))
+            touch("file")
+            parser = MetadataFolderParser("TestMDT", path, None, delete=False)
+            parser.parse_items()
+        self.assertEqual(
+            ["FolderWithoutMetaXml/Other", "Test", "Test/Test"], parser.members
+        )
+
     def test_parse_item__non_directory(self):
         with temporary_dir() as path:
             with open(os.path.join(path, "file"), "w"):
@@ -281,6 +347,16 @@ class TestMetadataXmlElementParser(unittest.TestCase):
             with self.assertRaises(MissingNameElementError):
                 parser()
 
+    def test_parser__invalid_xml(self):
+        with temporary_dir() as path:
+            with open(os.path.join(path, "Test.test"), "w") as f:
+                f.write("<root>")
+            parser = MetadataXmlElementParser(
+                "TestMDT", path, "test", delete=False, item_xpath="./sf:test"
+            )
+            with self.assertRaises(etree.XMLSyntaxError):
+                parser()
+
 
 class TestCustomLabelsParser(unittest.TestCase):
     def test_parser(self):
@@ -305,6 +381,11 @@ class TestCustomObjectParser(unittest.TestCase):
         parser = CustomObjectParser("CustomObject", None, "object", False)
         self.assertEqual(["Test__c"], parser._parse_item("Test__c.object"))
 
+    def test_parse_item__custom_suffixes(self):
+        parser = CustomObjectParser("CustomObject", None, "object", False)
+        for name in ("Test__mdt", "Test__e", "Test__b"):
+            self.assertEqual([name], parser._parse_item(name + ".object"))
+
     def test_parse_item__skips_namespaced(self):
         parser = CustomObjectParser("CustomObject", None, "object", False)
         self.assertEqual([], parser._parse_item("ns__Object__c.object"))
@@ -337,6 +418,19 @@ class TestDocumentParser(unittest.TestCase):
 
 
 class TestUpdatePackageXml(unittest.TestCase):
+    def _create_task(self, src_path, output_path, repo_root):
+        project_config = BaseProjectConfig(
+            UniversalConfig(),
+            {"project": {"package": {"name": "Test Package", "api_version": "36.0"}}},
+            repo_info={"root": repo_root},
+        )
+        options = {"path": src_path, "managed": True}
+        if output_path:
+            options["output"] = output_path
+        task_config = TaskConfig({"options": options})
+        org_config = OrgConfig({}, "test")
+        return UpdatePackageXml(project_config, task_config, org_config)
+
     def test_run_task(self):
         src_path = os.path.join(
             __location__, "package_metadata", "namespaced_report_folder"
@@ -362,3 +456,139 @@ class TestUpdatePackageXml(unittest.TestCase):
             with open(output_path, "r") as f:
                 result = f.read()
             self.assertEqual(expected, result)
+
+    def test_run_task__cached(self):
+        with temporary_dir() as path:
+            src_path = os.path.join(path, "src")
+            os.makedirs(os.path.join(src_path, "objects"))
+            object_path = os.path.join(src_path, "objects", "Test__c.object")
+            with open(object_path, "w") as f:
+                f.write("<CustomObject />")
+
+            task = self._create_task(src_path, None, path)
+            task()
+            with mock.patch.object(PackageXmlGenerator, "__call__") as generate:
+                task = self._create_task(src_path, None, path)
+                task()
+            generate.assert_not_called()
+            with open(os.path.join(src_path, "package.xml"), "r") as f:
+                self.assertIn("<members>Test__c</members>", f.read())
+
+            # Touching a metadata file invalidates the cache
+            stat = os.stat(object_path)
+            os.utime(object_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            with mock.patch.object(PackageXmlGenerator, "__call__") as generate:
+                generate.return_value = "<Package />"
+                task = self._create_task(src_path, None, path)
+                task()
+            generate.assert_called_once()
+
+    def test_run_task__corrupt_cache(self):
+        with temporary_dir() as path:
+            src_path = os.path.join(path, "src")
+            os.makedirs(os.path.join(src_path, "classes"))
+            touch(os.path.join(src_path, "classes", "Test.cls"))
+            task = self._create_task(src_path, None, path)
+            task()
+            cache_dir = os.path.join(path, ".cci", "package_xml")
+            (cache_name,) = os.listdir(cache_dir)
+            with open(os.path.join(cache_dir, cache_name), "w") as f:
+                f.write('{"fingerprint": "ab')
+            os.remove(os.path.join(src_path, "package.xml"))
+
+            task = self._create_task(src_path, None, path)
+            task()
+            with open(os.path.join(src_path, "package.xml"), "r") as f:
+                self.assertIn("<members>Test</members>", f.read())
+            self.assertEqual([cache_name], os.listdir(cache_dir))
+            with open(os.path.join(cache_dir, cache_name), "r") as f:
+                self.assertIn("package_xml", json.load(f))
+
+            # The rewritten entry is used on the next run
+            with mock.patch.object(PackageXmlGenerator, "__call__") as generate:
+                task = self._create_task(src_path, None, path)
+                task()
+            generate.assert_not_called()
+
+    def test_run_task__path_is_repo_root(self):
+        with temporary_dir() as path:
+            os.mkdir(os.path.join(path, ".git"))
+            touch(os.path.join(".git", "HEAD"))
+            touch(".DS_Store")
+            os.mkdir(os.path.join(path, "classes"))
+            touch(os.path.join("classes", "Test.cls"))
+            task = self._create_task(path, None, path)
+            task()
+            self.assertTrue(os.path.isdir(os.path.join(path, ".cci", "package_xml")))
+
+            with mock.patch.object(PackageXmlGenerator, "__call__") as generate:
+                task = self._create_task(path, None, path)
+                task()
+            generate.assert_not_called()
+
+    def test_get_cache_key__metadata_map_changed(self):
+        with temporary_dir() as path:
+            task = self._create_task(path, None, path)
+            task._init_task()
+            output = os.path.join(path, "package.xml")
+            cache_name, fingerprint = task._get_cache_key(output)
+            real_stat = os.stat
+
+            def fake_stat(p, *args, **kwargs):
+                result = real_stat(p, *args, **kwargs)
+                if str(p).endswith("metadata_map.yml"):
+                    return mock.Mock(st_mtime_ns=result.st_mtime_ns + 1, st_size=1)
+                return result
+
+            with mock.patch("os.stat", fake_stat):
+                changed_name, changed_fingerprint = task._get_cache_key(output)
+        self.assertNotEqual(cache_name, changed_name)
+        self.assertEqual(fingerprint, changed_fingerprint)
+
+    @unittest.skipIf(not hasattr(os, "symlink"), "symlinks not supported")
+    def test_run_task__symlinked_folder(self):
+        with temporary_dir() as path:
+            linked_path = os.path.join(path, "linked_classes")
+            os.mkdir(linked_path)
+            touch(os.path.join(linked_path, "A.cls"))
+            src_path = os.path.join(path, "src")
+            os.mkdir(src_path)
+            os.symlink(linked_path, os.path.join(src_path, "classes"))
+            # A link back up the tree must not send the fingerprint into a loop
+            os.symlink(src_path, os.path.join(linked_path, "loop"))
+            task = self._create_task(src_path, None, path)
+            task()
+
+            touch(os.path.join(linked_path, "B.cls"))
+            task = self._create_task(src_path, None, path)
+            task()
+            with open(os.path.join(src_path, "package.xml"), "r") as f:
+                result = f.read()
+            self.assertIn("<members>A</members>", result)
+            self.assertIn("<members>B</members>", result)
+
+    def test_run_task__new_empty_bundle(self):
+        with temporary_dir() as path:
+            src_path = os.path.join(path, "src")
+            os.makedirs(os.path.join(src_path, "aura", "a"))
+            touch(os.path.join(src_path, "aura", "a", "a.cmp"))
+            task = self._create_task(src_path, None, path)
+            task()
+
+            os.mkdir(os.path.join(src_path, "aura", "b"))
+            task = self._create_task(src_path, None, path)
+            task()
+            with open(os.path.join(src_path, "package.xml"), "r") as f:
+                result = f.read()
+            self.assertIn("<members>a</members>", result)
+            self.assertIn("<members>b</members>", result)
+
+    def test_run_task__no_repo_root(self):
+        with temporary_dir() as path:
+            os.mkdir(os.path.join(path, "classes"))
+            touch(os.path.join("classes", "Test.cls"))
+            task = self._create_task(path, None, None)
+            with mock.patch.object(UpdatePackageXml, "_get_cache_key") as cache_key:
+                task()
+            cache_key.assert_not_called()
+            self.assertTrue(os.path.exists(os.path.join(path, "package.xml")))